@@ -24,6 +24,14 @@ class ModelArguments:
     tokenizer_name: Optional[str] = field(
         default=None, metadata={"help": "Pretrained tokenizer name or path if not the same as model_name"}
     )
+    torch_compile: bool = field(
+        default=False,
+        metadata={"help": "Whether to compile the model with torch.compile before training"}
+    )
+    torch_compile_mode: str = field(
+        default="default",
+        metadata={"help": "torch.compile mode. Choose one of ['default', 'reduce-overhead', 'max-autotune']"}
+    )
     retrieval_type: Optional[str] = field(
         default="elastic", metadata={"help": "Pretrained tokenizer name or path if not the same as model_name"}
     )
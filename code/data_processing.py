@@ -2,10 +2,11 @@ from datasets import load_metric, load_from_disk
 from transformers import AutoConfig, AutoModelForQuestionAnswering, AutoTokenizer
 
 class DataProcessor():
-    def __init__(self, tokenizer, max_length = 384, doc_stride = 128):
+    def __init__(self, tokenizer, max_length = 384, doc_stride = 128, num_proc = 4):
         self.tokenizer = tokenizer
         self.max_length = max_length
         self.doc_stride = doc_stride
+        self.num_proc = num_proc
     
     def prepare_train_features(self, examples):
         tokenized_examples = self.tokenizer(
@@ -109,7 +110,7 @@ class DataProcessor():
         train_dataset = train_dataset.map(
             self.prepare_train_features,
             batched=True,
-            num_proc=4,
+            num_proc=self.num_proc,
             remove_columns=column_names,
         )
 
@@ -119,8 +120,8 @@ class DataProcessor():
         val_dataset = val_dataset.map(
             self.prepare_validation_features,
             batched=True,
-            num_proc=4,
+            num_proc=self.num_proc,
             remove_columns=column_names,
         )
 
-        return val_dataset
\ No newline at end of file
+        return val_dataset
@@ -5,6 +5,7 @@ import time
 import json
 
 import torch
+import torch.nn.functional as F
 import random
 import numpy as np
 import pandas as pd
@@ -30,6 +31,10 @@ from transformers import (
     set_seed,
 )
 
+from model.ConvModel import ConvModel
+from model.QueryAttentionModel import QueryAttentionModel
+from model.QAConvModelV1 import QAConvModelV1
+from model.QAConvModelV2 import QAConvModelV2
 from elasticsearch_retrieval import *
 from data_processing import DataProcessor
 from utils_qa import postprocess_qa_predictions, check_no_error, tokenize, cos_sim
@@ -90,11 +95,35 @@ def get_model(model_args, training_args):
     Returns:
         tokenizer, model
     """
+    # train_mrc.py가 checkpoint 옆에 저장한 model argument로 model 구조를 맞춘다
+    saved_args_path = os.path.join(os.path.dirname(model_args.model_name_or_path), "model_args.json")
+    if os.path.isfile(saved_args_path):
+        with open(saved_args_path, "r") as f:
+            saved_args = json.load(f)
+        model_args.use_custom_model = saved_args["use_custom_model"]
+        model_args.config_name = model_args.config_name or saved_args["config_name"] or saved_args["model_name_or_path"]
+        model_args.tokenizer_name = model_args.tokenizer_name or saved_args["tokenizer_name"] or saved_args["model_name_or_path"]
+    else:
+        model_args.config_name = model_args.config_name or model_args.model_name_or_path
+        model_args.tokenizer_name = model_args.tokenizer_name or model_args.model_name_or_path
+
     tokenizer = AutoTokenizer.from_pretrained(
         model_args.tokenizer_name,
         use_fast=True
     )
-    model = torch.load(model_args.model_name_or_path)
+    model_config = AutoConfig.from_pretrained(model_args.config_name)
+    # train_mrc.py는 state_dict만 저장하므로 model 구조를 다시 만든 뒤 weight를 불러온다
+    if model_args.use_custom_model == 'ConvModel':
+        model = ConvModel(model_args.config_name, model_config, model_args.tokenizer_name)
+    elif model_args.use_custom_model == 'QueryAttentionModel':
+        model = QueryAttentionModel(model_args.config_name, model_config, model_args.tokenizer_name)
+    elif model_args.use_custom_model == 'QAConvModelV1':
+        model = QAConvModelV1(model_args.config_name, model_config, model_args.tokenizer_name)
+    elif model_args.use_custom_model == 'QAConvModelV2':
+        model = QAConvModelV2(model_args.config_name, model_config, model_args.tokenizer_name)
+    else:
+        model = AutoModelForQuestionAnswering.from_config(model_config)
+    model.load_state_dict(torch.load(model_args.model_name_or_path, map_location='cpu'))
 
     return tokenizer, model
 
@@ -277,20 +306,12 @@ def post_processing_function(features, predictions, text_data, data_args, traini
 
     
 def create_and_fill_np_array(start_or_end_logits, dataset, max_len):
-    step = 0
-
-    logits_concat = np.full((len(dataset), max_len), -100, dtype=np.float64)
-
-    for i, output_logit in enumerate(start_or_end_logits):
-        batch_size = output_logit.shape[0]
-        cols = output_logit.shape[1]
-
-        if step + batch_size < len(dataset):
-            logits_concat[step : step + batch_size, :cols] = output_logit
-        else:
-            logits_concat[step:, :cols] = output_logit[: len(dataset) - step]
-
-        step += batch_size
+    # GPU 위에서 max_len까지 padding 후 한 번에 연결하고, host로는 한 번만 복사
+    padded_logits = [
+        F.pad(output_logit.float(), (0, max_len - output_logit.size(1)), value=-100.0)
+        for output_logit in start_or_end_logits
+    ]
+    logits_concat = torch.cat(padded_logits, dim=0)[: len(dataset)].cpu().numpy()
 
     return logits_concat
 
@@ -330,10 +351,10 @@ def predict(model, text_data, test_loader, test_dataset, model_args, data_args,
             end_logits = outputs.end_logits
 
 
-        all_start_logits.append(start_logits.detach().cpu().numpy())
-        all_end_logits.append(end_logits.detach().cpu().numpy())
+        all_start_logits.append(start_logits.detach())
+        all_end_logits.append(end_logits.detach())
     
-    max_len = max(x.shape[1] for x in all_start_logits)
+    max_len = max(x.size(1) for x in all_start_logits)
 
     start_logits_concat = create_and_fill_np_array(all_start_logits, test_dataset, max_len)
     end_logits_concat = create_and_fill_np_array(all_end_logits, test_dataset, max_len)
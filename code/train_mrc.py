@@ -1,9 +1,13 @@
 import os
 import sys
 import time
+import json
 import pickle
+import hashlib
 import random
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
 
 import wandb
 import torch
@@ -11,10 +15,11 @@ import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from torch import nn
+import torch.nn.functional as F
 from torch.utils.data import DataLoader
 from torch.cuda.amp import autocast, GradScaler
-from datasets import load_metric, load_from_disk, load_dataset
-from transformers import AutoConfig, AutoModelForQuestionAnswering, AutoTokenizer, AdamW, get_cosine_with_hard_restarts_schedule_with_warmup
+from datasets import load_metric, load_from_disk, load_dataset, DatasetDict
+from transformers import AutoConfig, AutoModelForQuestionAnswering, AutoTokenizer, get_linear_schedule_with_warmup
 from transformers import (
     DataCollatorWithPadding,
     EvalPrediction,
@@ -27,13 +32,17 @@ from model.ConvModel import ConvModel
 from model.QueryAttentionModel import QueryAttentionModel
 from model.QAConvModelV1 import QAConvModelV1
 from model.QAConvModelV2 import QAConvModelV2
-from utils_qa import postprocess_qa_predictions, check_no_error, tokenize, AverageMeter, last_processing
+from utils_qa import postprocess_qa_predictions, check_no_error, tokenize, last_processing
 from trainer_qa import QuestionAnsweringTrainer
 from arguments import ModelArguments, DataTrainingArguments
 from data_processing import DataProcessor
 # from prepare_dataset import make_custom_dataset
 
 
+# training step마다 question에 random masking을 적용할 확률
+MASK_PROPS = 0.8
+
+
 def get_args() :
     '''훈련 시 입력한 각종 Argument를 반환하는 함수'''
     parser = HfArgumentParser((ModelArguments, DataTrainingArguments, TrainingArguments))
@@ -42,22 +51,26 @@ def get_args() :
     return model_args, data_args, training_args
 
 
-def set_seed_everything(seed):
+def set_seed_everything(seed, deterministic=False):
     '''Random Seed를 고정하는 함수'''
     random.seed(seed)
     os.environ['PYTHONHASHSEED'] = str(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = True
+    # deterministic과 benchmark는 서로 반대이므로 재현성이 필요할 때만 deterministic 사용
+    torch.backends.cudnn.deterministic = deterministic
+    torch.backends.cudnn.benchmark = not deterministic
+    # fp32 연산도 Ampere 이상에서는 TF32 tensor core 사용
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
     set_seed(seed)
 
     return None
 
 
-def get_model(model_args, training_args) :
-    '''tokenizer, model_config, model, optimizer, scaler, shceduler를 반환하는 함수'''
+def get_model(model_args, training_args, device) :
+    '''tokenizer, model_config, model, optimizer, scaler를 반환하는 함수'''
     # Load pretrained model and tokenizer
     model_config = AutoConfig.from_pretrained(
         model_args.config_name
@@ -87,16 +100,29 @@ def get_model(model_args, training_args) :
         )
         
     if model_args.use_pretrained_model:
-        pretrained_model = torch.load(f'/opt/ml/output/{model_args.model_name_or_path}/{model_args.model_name_or_path}.pt')
-        pretrained_model_state = deepcopy(pretrained_model.state_dict())
+        pretrained_model_state = torch.load(f'/opt/ml/output/{model_args.model_name_or_path}/{model_args.model_name_or_path}.pt', map_location='cpu')
         model.load_state_dict(pretrained_model_state)
-        del pretrained_model
+        del pretrained_model_state
         
-    optimizer = AdamW(model.parameters(), lr=training_args.learning_rate)
-    scaler = GradScaler()
-    scheduler = get_cosine_with_hard_restarts_schedule_with_warmup(optimizer=optimizer, num_warmup_steps=1000, num_training_steps=12820, num_cycles=2)
+    # fused optimizer는 parameter가 GPU에 있어야 하므로 optimizer 생성 전에 model을 옮긴다
+    model.to(device)
+    # fused=True면 parameter마다 loop를 돌지 않고 하나의 CUDA kernel로 update
+    optimizer = torch.optim.AdamW(model.parameters(), lr=training_args.learning_rate, weight_decay=training_args.weight_decay, eps=1e-6, fused=device.type == "cuda")
+    # bf16은 fp32와 같은 range를 가지므로 Ampere 이상에서는 loss scaling이 필요없다
+    if training_args.bf16 and torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+        scaler = None
+    else:
+        scaler = GradScaler()
+
+    return tokenizer, model_config, model, optimizer, scaler
+
 
-    return tokenizer, model_config, model, optimizer, scaler, scheduler 
+def get_scheduler(optimizer, train_loader, training_args) :
+    '''전체 training step에 맞춰 매 step마다 warmup + linear decay하는 scheduler를 반환하는 함수'''
+    num_training_steps = int(training_args.num_train_epochs) * len(train_loader)
+    scheduler = get_linear_schedule_with_warmup(optimizer=optimizer, num_warmup_steps=int(0.1 * num_training_steps), num_training_steps=num_training_steps)
+
+    return scheduler
 
 
 def get_pickle(pickle_path):
@@ -162,13 +188,35 @@ def get_data(data_args, training_args, tokenizer) :
         train_column_names = train_dataset.column_names
         val_column_names = val_dataset.column_names
 
-        data_processor = DataProcessor(tokenizer, data_args.max_seq_length, data_args.doc_stride)
-        train_dataset = data_processor.train_tokenizer(train_dataset, train_column_names)
-        val_dataset = data_processor.val_tokenzier(val_dataset, val_column_names)
-
-    data_collator = (DataCollatorWithPadding(tokenizer, pad_to_multiple_of=8 if training_args.fp16 else None))
-    train_iter = DataLoader(train_dataset, collate_fn = data_collator, batch_size=training_args.per_device_train_batch_size)
-    val_iter = DataLoader(val_dataset, collate_fn = data_collator, batch_size=training_args.per_device_eval_batch_size)
+        # tokenize 결과를 통째로 disk에 저장해서 두번째 실행부터는 tokenize를 건너뛴다
+        cache_dir = "../data/cache"
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_key = f"{data_args.dataset_name}_{tokenizer.name_or_path}_{data_args.max_seq_length}_{data_args.doc_stride}"
+        cache_hash = hashlib.md5(f"{cache_key}_{train_dataset._fingerprint}_{val_dataset._fingerprint}".encode()).hexdigest()
+        tokenized_path = os.path.join(cache_dir, f"tok_{cache_hash}")
+
+        if os.path.isdir(tokenized_path) and not data_args.overwrite_cache :
+            tokenized_dataset = load_from_disk(tokenized_path)
+            train_dataset = tokenized_dataset['train']
+            val_dataset = tokenized_dataset['validation']
+        else :
+            num_proc = data_args.preprocessing_num_workers or os.cpu_count()
+            data_processor = DataProcessor(tokenizer, data_args.max_seq_length, data_args.doc_stride, num_proc)
+            train_dataset = data_processor.train_tokenizer(train_dataset, train_column_names)
+            val_dataset = data_processor.val_tokenzier(val_dataset, val_column_names)
+            DatasetDict({'train': train_dataset, 'validation': val_dataset}).save_to_disk(tokenized_path)
+
+    # tensor core를 쓰기 위해 fp16/tf32는 8, bf16은 16의 배수로 항상 padding
+    data_collator = (DataCollatorWithPadding(tokenizer, pad_to_multiple_of=16 if training_args.bf16 else 8))
+    # collate를 worker에서 미리 처리하고 pinned memory로 GPU 전송을 비동기화
+    num_workers = min(8, os.cpu_count() or 1)
+    train_iter = DataLoader(train_dataset, collate_fn = data_collator, batch_size=training_args.per_device_train_batch_size,
+                            num_workers=num_workers, pin_memory=True, persistent_workers=True, prefetch_factor=4, shuffle=True)
+    # validation은 model 입력 column만 torch format으로 한 번만 고정(원본 val_dataset은 post processing에 사용)
+    val_columns = ["attention_mask", "input_ids"] if "xlm" in tokenizer.name_or_path else ["attention_mask", "input_ids", "token_type_ids"]
+    val_input_dataset = val_dataset.with_format(type="torch", columns=val_columns)
+    val_iter = DataLoader(val_input_dataset, collate_fn = data_collator, batch_size=training_args.per_device_eval_batch_size,
+                          num_workers=num_workers, pin_memory=True, persistent_workers=True, prefetch_factor=4, shuffle=False)
 
     return dataset, train_iter, val_iter, train_dataset, val_dataset
 
@@ -196,44 +244,36 @@ def post_processing_function(examples, features, predictions, text_data, data_ar
     return EvalPrediction(predictions=formatted_predictions, label_ids=references)
 
 
-def create_and_fill_np_array(start_or_end_logits, dataset, max_len):
+def create_and_fill_np_array(start_or_end_logits, dataset):
     '''Model의 Logit을 Context 단위로 연결하기 위한 함수'''
-    step = 0
-    logits_concat = np.full((len(dataset), max_len), -100, dtype=np.float64)
-
-    for i, output_logit in enumerate(start_or_end_logits):
-        batch_size = output_logit.shape[0]
-        cols = output_logit.shape[1]
-        if step + batch_size < len(dataset):
-            logits_concat[step : step + batch_size, :cols] = output_logit
-        else:
-            logits_concat[step:, :cols] = output_logit[: len(dataset) - step]
-        step += batch_size
+    # 뒤쪽 batch가 더 넓었다면 앞쪽 batch도 같은 길이로 맞춘 뒤(crop 없이 padding만) GPU 위에서 연결하고, host로는 한 번만 복사
+    max_len = max(x.size(1) for x in start_or_end_logits)
+    padded_logits = [x if x.size(1) == max_len else F.pad(x, (0, max_len - x.size(1)), value=-100.0) for x in start_or_end_logits]
+    logits_concat = torch.cat(padded_logits, dim=0)[: len(dataset)].cpu().numpy()
 
     return logits_concat
 
 
 def custom_to_mask(batch, tokenizer):
     '''Question 부분에 Random Masking을 적용하는 함수'''
-    mask_token = tokenizer.mask_token_id
-    
-    for i in range(len(batch["input_ids"])):
-        # sep 토큰으로 question과 context가 나뉘어져 있다.
-        sep_idx = np.where(batch["input_ids"][i].numpy() == tokenizer.sep_token_id)
-        # q_ids = > 첫번째 sep 토큰위치
-        q_ids = sep_idx[0][0]
-        mask_idxs = set()
-        while len(mask_idxs) < 1:
-            # 1 ~ q_ids까지가 Question 위치
-            ids = random.randrange(1, q_ids)
-            mask_idxs.add(ids)
-
-        for mask_idx in list(mask_idxs):
-            batch["input_ids"][i][mask_idx] = mask_token
-    
+    input_ids = batch["input_ids"]
+    # sep 토큰으로 question과 context가 나뉘어져 있다. => 각 row의 첫번째 sep 토큰위치
+    first_sep = (input_ids == tokenizer.sep_token_id).float().argmax(dim=1)
+    # 1 ~ first_sep-1까지가 Question 위치, row마다 하나씩 뽑는다
+    rand = torch.rand(input_ids.size(0), device=input_ids.device)
+    mask_pos = 1 + (rand * (first_sep - 1).clamp(min=1).float()).long()
+    input_ids.scatter_(1, mask_pos.unsqueeze(1), tokenizer.mask_token_id)
+
     return batch
 
 
+def get_autocast(scaler):
+    '''scaler가 없으면(bf16) bf16 autocast를, 있으면 기본 fp16 autocast를 반환하는 함수'''
+    if scaler is None:
+        return autocast(dtype=torch.bfloat16)
+    return autocast()
+
+
 def cal_loss(start_positions, end_positions, start_logits, end_logits):
     '''MRC Task에서 Loss를 계산하는 함수'''
     total_loss =None
@@ -262,14 +302,14 @@ def cal_query_loss(question_type, query_logits) :
 def training_per_step(model, optimizer, scaler, batch, model_args, data_args, training_args, tokenizer, device):
     '''매 step마다 학습을 하는 함수'''
     model.train()
-    with autocast():
-        mask_props = 0.8
-        mask_p = random.random()
-        if mask_p < mask_props:
-            # 확률 안에 들면 mask 적용
-            batch = custom_to_mask(batch, tokenizer)
-
-        batch = batch.to(device)
+    optimizer.zero_grad(set_to_none=True)
+    batch = {k: v.to(device, non_blocking=True) for k, v in batch.items()}
+
+    if random.random() < MASK_PROPS:
+        # 확률 안에 들면 GPU 위에서 바로 mask 적용
+        batch = custom_to_mask(batch, tokenizer)
+
+    with get_autocast(scaler):
         outputs = model(**batch)
 
         # output안에 loss가 들어있는 형태
@@ -279,28 +319,29 @@ def training_per_step(model, optimizer, scaler, batch, model_args, data_args, tr
                 loss += cal_query_loss(batch['question_type'], outputs['query_logits'])
         else:
             loss = outputs.loss
+
+    # backward와 optimizer step은 autocast 밖에서 진행
+    if scaler is None:
+        loss.backward()
+        optimizer.step()
+    else:
         scaler.scale(loss).backward()
         scaler.step(optimizer)
         scaler.update()
-        optimizer.zero_grad()
 
-    return loss.item()
+    return loss.detach()
 
 
 def validating_per_steps(epoch, model, text_data, test_loader, test_dataset, model_args, data_args, training_args, device):
-    '''특정 step마다 검증을 하는 함수'''
-    metric = load_metric("squad")
-    if "xlm" in model_args.tokenizer_name:
-        test_dataset.set_format(type="torch", columns=["attention_mask", "input_ids"])
-    else:
-        test_dataset.set_format(type="torch", columns=["attention_mask", "input_ids", "token_type_ids"])
-
+    '''특정 step마다 검증 data에 대한 logit을 계산하는 함수'''
     model.eval()
     all_start_logits = []
     all_end_logits = []
+    # 보통 tokenizer가 max_length로 padding하므로 logit 길이는 max_seq_length로 고정
+    max_len = data_args.max_seq_length
 
     for batch in test_loader :
-        batch = batch.to(device)
+        batch = {k: v.to(device, non_blocking=True) for k, v in batch.items()}
         outputs = model(**batch)
         if model_args.use_custom_model:
             start_logits = outputs["start_logits"]
@@ -309,76 +350,141 @@ def validating_per_steps(epoch, model, text_data, test_loader, test_dataset, mod
             start_logits = outputs.start_logits
             end_logits = outputs.end_logits
         
-        all_start_logits.append(start_logits.detach().cpu().numpy())
-        all_end_logits.append(end_logits.detach().cpu().numpy())
-    
-    max_len = max(x.shape[1] for x in all_start_logits)
+        # collator padding이나 미리 tokenize된 dataset 때문에 더 넓은 batch가 오면 logit을 자르지 않도록 max_len을 늘린다
+        max_len = max(max_len, start_logits.size(1))
+        all_start_logits.append(F.pad(start_logits.detach().float(), (0, max_len - start_logits.size(1)), value=-100.0))
+        all_end_logits.append(F.pad(end_logits.detach().float(), (0, max_len - end_logits.size(1)), value=-100.0))
 
-    start_logits_concat = create_and_fill_np_array(all_start_logits, test_dataset, max_len)
-    end_logits_concat = create_and_fill_np_array(all_end_logits, test_dataset, max_len)
+    start_logits_concat = create_and_fill_np_array(all_start_logits, test_dataset)
+    end_logits_concat = create_and_fill_np_array(all_end_logits, test_dataset)
 
     del all_start_logits
     del all_end_logits
     
-    test_dataset.set_format(type=None, columns=list(test_dataset.features.keys()))
     output_numpy = (start_logits_concat, end_logits_concat)
+
+    return output_numpy
+
+
+def snapshot_model_state(model, model_state):
+    '''검증 시점의 weight를 미리 할당한 pinned CPU buffer로 비동기 복사하는 함수'''
+    # torch.compile로 감싼 경우 원래 model 기준
+    state_dict = getattr(model, "_orig_mod", model).state_dict()
+    if model_state is None:
+        model_state = {k: torch.empty(v.shape, dtype=v.dtype, pin_memory=v.is_cuda) for k, v in state_dict.items()}
+    for k, v in state_dict.items():
+        model_state[k].copy_(v.detach(), non_blocking=True)
+
+    # 복사가 끝났는지는 저장할 때만 확인
+    copy_done = None
+    if torch.cuda.is_available():
+        copy_done = torch.cuda.Event()
+        copy_done.record()
+
+    return model_state, copy_done
+
+
+def evaluate_and_save(output_numpy, model_state, copy_done, best_f1, text_data, test_dataset, data_args, training_args):
+    '''background thread에서 post processing과 metric 계산 후 best model이면 저장하는 함수'''
+    metric = load_metric("squad")
     prediction = post_processing_function(text_data["validation"], test_dataset, output_numpy, text_data, data_args, training_args)
     val_metric = metric.compute(predictions=prediction.predictions, references=prediction.label_ids)
+    if val_metric["f1"] > best_f1:
+        if copy_done is not None:
+            copy_done.synchronize()
+        torch.save(model_state, training_args.output_dir + f"/{training_args.run_name}.pt")
 
     return val_metric
 
 
+def log_val_metric(pending, prev_f1, prev_em):
+    '''background에서 계산된 검증 결과를 기다려 wandb에 기록하고 best score를 반환하는 함수'''
+    future, train_log = pending
+    val_metric = future.result()
+    if val_metric["f1"] > prev_f1:
+        prev_f1 = val_metric["f1"]
+        prev_em = val_metric["exact_match"]
+    wandb.log({
+    **train_log,
+    'eval/exact_match' : val_metric['exact_match'],
+    'eval/f1_score' : val_metric['f1'],
+    })
+
+    return prev_f1, prev_em
+
+
 def train_mrc(model, optimizer, scaler, text_data, train_loader, test_loader, train_dataset, test_dataset, scheduler, model_args, data_args, training_args, tokenizer, device):
     '''training과 validating을 진행하는 함수'''
     prev_f1 = 0
     prev_em = 0
     global_steps = 0
-    train_loss = AverageMeter()
+    # loss는 GPU 위에서 누적하고 logging step에서만 host와 동기화
+    loss_accum = torch.zeros((), device=device)
+    n_accum = 0
+    train_loss = 0.0
+    # post processing은 background thread 하나에서 순서대로 진행
+    executor = ThreadPoolExecutor(max_workers=1)
+    pending = None
+    # 검증 시점 weight를 담을 pinned buffer(처음 검증할 때 한 번만 할당)
+    model_state = None
     for epoch in range(int(training_args.num_train_epochs)):
         pbar = tqdm(enumerate(train_loader), total=len(train_loader), position=0, leave=True)
         for step, batch in pbar:
             # training phase
             loss = training_per_step(model, optimizer, scaler, batch, model_args, data_args, training_args, tokenizer, device)
-            train_loss.update(loss, len(batch['input_ids']))
+            batch_size = len(batch['input_ids'])
+            loss_accum += loss * batch_size
+            n_accum += batch_size
             global_steps += 1
-            description = f"{epoch+1}epoch {global_steps: >5d}step | loss: {train_loss.avg: .4f} | best_f1: {prev_f1: .4f} | em : {prev_em: .4f}"
+            description = f"{epoch+1}epoch {global_steps: >5d}step | loss: {train_loss: .4f} | best_f1: {prev_f1: .4f} | em : {prev_em: .4f}"
             pbar.set_description(description)
             if scheduler is not None :
                 scheduler.step()
 
             # validating phase
             if global_steps % training_args.logging_steps == 0 :
-                with torch.no_grad():
-                    val_metric = validating_per_steps(epoch, model, text_data, test_loader, test_dataset, model_args, data_args, training_args, device)
-                if val_metric["f1"] > prev_f1:
-                    torch.save(model, training_args.output_dir + f"/{training_args.run_name}.pt")
-                    prev_f1 = val_metric["f1"]
-                    prev_em = val_metric["exact_match"]
-                wandb.log({
-                'train/loss' : train_loss.avg,
+                train_loss = (loss_accum / n_accum).item()
+                loss_accum.zero_()
+                n_accum = 0
+                # 이전 검증 결과를 먼저 반영해야 best_f1 기준이 최신으로 유지된다
+                if pending is not None :
+                    prev_f1, prev_em = log_val_metric(pending, prev_f1, prev_em)
+                    pending = None
+                with torch.inference_mode(), get_autocast(scaler):
+                    output_numpy = validating_per_steps(epoch, model, text_data, test_loader, test_dataset, model_args, data_args, training_args, device)
+                # 검증한 시점의 weight를 pinned buffer로 비동기 복사해두고, post processing과 저장은 background에서 진행
+                # 이전 결과를 위에서 기다렸으므로 buffer를 덮어써도 안전하다
+                model_state, copy_done = snapshot_model_state(model, model_state)
+                future = executor.submit(evaluate_and_save, output_numpy, model_state, copy_done, prev_f1, text_data, test_dataset, data_args, training_args)
+                pending = (future, {
+                'train/loss' : train_loss,
                 'train/learning_rate' : scheduler.get_last_lr()[0] if scheduler is not None else training_args.learning_rate,
-                'eval/exact_match' : val_metric['exact_match'],
-                'eval/f1_score' : val_metric['f1'],
                 'global_steps': global_steps
                 })
-                train_loss.reset()
-            else : 
-                wandb.log({'global_steps':global_steps})
+
+    if pending is not None :
+        log_val_metric(pending, prev_f1, prev_em)
+    executor.shutdown()
 
 
 def main():
     '''각종 설정 이후 train_mrc를 실행하는 함수'''
     model_args, data_args, training_args = get_args()
     training_args.output_dir = os.path.join(training_args.output_dir, training_args.run_name)
-    set_seed_everything(training_args.seed)
+    set_seed_everything(training_args.seed, training_args.full_determinism)
     device=torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-    tokenizer, model_config, model, optimizer, scaler, scheduler  = get_model(model_args, training_args)
+    tokenizer, model_config, model, optimizer, scaler = get_model(model_args, training_args, device)
     text_data, train_loader, val_loader, train_dataset, val_dataset = get_data(data_args, training_args, tokenizer)
-    model.cuda()
+    scheduler = get_scheduler(optimizer, train_loader, training_args)
+    if model_args.torch_compile:
+        model = torch.compile(model, mode=model_args.torch_compile_mode, fullgraph=False)
 
     if not os.path.isdir(training_args.output_dir) :
         os.mkdir(training_args.output_dir)
+    # state_dict로 저장하므로 inference에서 model을 다시 만들 때 필요한 argument를 같이 저장
+    with open(os.path.join(training_args.output_dir, "model_args.json"), "w") as f :
+        json.dump(asdict(model_args), f, indent=4)
 
     # set wandb
     os.environ['WANDB_LOG_MODEL'] = 'true'